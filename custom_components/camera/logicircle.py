@@ -3,27 +3,46 @@ Support for Logi Circle 2 Cameras.
 """
 
 import asyncio
+import email.utils
+import itertools
+import json
 import logging
-import weakref
 import time
 
 import aiohttp
-import async_timeout
 import voluptuous as vol
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 from homeassistant.const import (
-    CONF_NAME, CONF_USERNAME, CONF_PASSWORD)
+    CONF_NAME, CONF_USERNAME, CONF_PASSWORD, EVENT_HOMEASSISTANT_CLOSE)
 from homeassistant.components.camera import (
     PLATFORM_SCHEMA, Camera)
-from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers import config_validation as cv
 from homeassistant.util.async_ import run_coroutine_threadsafe
 
+# orjson needs Python 3.8+, stdlib json is used whenever it is not installed.
+REQUIREMENTS = ['orjson==3.9.10; python_version >= "3.8"']
+
 _LOGGER = logging.getLogger(__name__)
 
 DEFAULT_NAME = 'Logi Cam'
 PLATFORM = 'logicircle'
+JSON_HEADERS = {'content-type': 'application/json'}
+MAX_CONCURRENT_REQUESTS = 8
+IMAGE_FETCH_TIMEOUT = 10
+# Longest delay in seconds between image fetch retries after failures.
+MAX_RETRY_INTERVAL = 300
+# Frame intervals without a consumer before background refresh pauses.
+IDLE_FRAME_COUNT = 50
+# Largest Content-Length in bytes trusted for preallocating a snapshot.
+MAX_IMAGE_PREALLOCATE = 4 * 1024 * 1024
+# Seconds before session cookie expiry to renew the login.
+COOKIE_RENEW_MARGIN = 60
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
@@ -31,34 +50,206 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_USERNAME): cv.string,
 })
 
+def _json_loads(data):
+    """Decode json payload, using orjson where it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def _json_dumps(obj):
+    """Encode json payload, using orjson where it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def _in_event_loop(loop):
+    """Return True if called from the thread running the given loop."""
+    try:
+        return loop.is_running() and asyncio.get_event_loop() is loop
+    except RuntimeError:
+        return False
+
+
+def _cookie_ttl(cookie):
+    """Return seconds until the cookie expires, None if unknown."""
+    try:
+        if cookie['max-age']:
+            return int(cookie['max-age'])
+        if cookie['expires']:
+            expires = email.utils.mktime_tz(email.utils.parsedate_tz(cookie['expires']))
+            return expires - time.time()
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+async def _async_read_body(response):
+    """Read response body into a buffer preallocated from Content-Length."""
+    try:
+        length = int(response.headers.get(aiohttp.hdrs.CONTENT_LENGTH, 0))
+    except ValueError:
+        length = 0
+    if not 0 < length <= MAX_IMAGE_PREALLOCATE:
+        length = 0
+    buffer = bytearray(length)
+    offset = 0
+    async for chunk in response.content.iter_any():
+        end = offset + len(chunk)
+        # Slice assignment grows the buffer if the body outruns the header.
+        buffer[offset:end] = chunk
+        offset = end
+    del buffer[offset:]
+    return bytes(buffer)
+
+
+class _PlatformRequest:
+    """Platform request holding a concurrency slot until the response is released.
+
+    Logs in before sending, on 401 logs in again and retries once.
+    """
+
+    def __init__(self, platform, method, url, session, kwargs):
+        """Init with platform, request parameters and session to use."""
+        self._platform = platform
+        self._method = method
+        self._url = url
+        self._session = session
+        self._kwargs = kwargs
+        self._response = None
+
+    async def __aenter__(self):
+        """Send the request and return its response."""
+        platform = self._platform
+        await platform._ensure_logged_in()
+        response = await self._async_send()
+        if response.status == 401:
+            # Free the slot while logging in, login needs one as well.
+            self._release(response)
+            platform._authed = False
+            await platform._ensure_logged_in()
+            response = await self._async_send()
+        self._response = response
+        return response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """Release the response and its concurrency slot."""
+        self._release(self._response)
+
+    async def _async_send(self):
+        """Acquire a concurrency slot and send the request."""
+        await self._platform._sem.acquire()
+        try:
+            return await self._session.request(self._method, self._url, **self._kwargs)
+        except BaseException:
+            self._platform._sem.release()
+            raise
+
+    def _release(self, response):
+        """Release response and its concurrency slot."""
+        response.release()
+        self._platform._sem.release()
+
+
 class LogiPlatform:
     """Platform for Logi Circle 2 Camera."""
-    def __init__(self, email, password, websession):
-        """Initialize with transport and credentials."""
+    def __init__(self, email, password):
+        """Initialize with credentials and a dedicated keep-alive session."""
         self._email = email
         self._password = password
-        self.session = websession
-        self._last_status = 401
+        connector = aiohttp.TCPConnector(limit=64, limit_per_host=8,
+                                         keepalive_timeout=75,
+                                         enable_cleanup_closed=True)
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers=JSON_HEADERS)
+        self._authed = False
+        self._login_lock = asyncio.Lock()
+        self._sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        self._cookie_expires = 0
+        self._renew_task = None
+        self._node_sessions = {}
+
+    def session_for(self, node_id):
+        """Return keep-alive session dedicated to the camera node host.
+
+        Node sessions share the platform cookie jar so login applies to them.
+        """
+        session = self._node_sessions.get(node_id)
+        if session is None:
+            connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=120,
+                                             force_close=False)
+            session = aiohttp.ClientSession(connector=connector,
+                                            cookie_jar=self.session.cookie_jar,
+                                            headers=JSON_HEADERS)
+            self._node_sessions[node_id] = session
+        return session
+
+    async def async_close(self):
+        """Stop login renewal and close the platform sessions."""
+        if self._renew_task is not None:
+            self._renew_task.cancel()
+            self._renew_task = None
+        for session in self._node_sessions.values():
+            await session.close()
+        self._node_sessions.clear()
+        await self.session.close()
 
     async def async_login(self):
         """Perform login using provided credentials."""
         payload = {'email': self._email, 'password': self._password}
         url = 'https://video.logi.com/api/accounts/authorization'
-        async with self.session.post(url, json=payload) as response:
+        async with self._sem, self.session.post(url, data=_json_dumps(payload)) as response:
             response.raise_for_status()
-            return response.cookies['prod_session']
+            cookie = response.cookies['prod_session']
+            self._authed = True
+
+        ttl = _cookie_ttl(cookie)
+        # Expiry in the past or within the margin (clock skew, delete
+        # cookie) is treated as unknown rather than renewed in a loop.
+        if ttl is not None and ttl > COOKIE_RENEW_MARGIN:
+            self._cookie_expires = time.monotonic() + ttl - COOKIE_RENEW_MARGIN
+            if self._renew_task is None:
+                self._renew_task = asyncio.ensure_future(self._async_auto_renew())
+        else:
+            self._cookie_expires = 0
+        return cookie
+
+    async def _async_auto_renew(self):
+        """Login again shortly before the session cookie expires."""
+        try:
+            while self._cookie_expires:
+                await asyncio.sleep(self._cookie_expires - time.monotonic())
+                async with self._login_lock:
+                    if time.monotonic() < self._cookie_expires:
+                        # Renewed by someone else meanwhile.
+                        continue
+                    try:
+                        await self.async_login()
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as err:  # pylint: disable=broad-except
+                        _LOGGER.error("Error renewing login: %s", err)
+                        self._authed = False
+                        self._cookie_expires = 0
+        finally:
+            self._renew_task = None
 
     @property
     def needs_login(self):
         """Identify if platform needs login/re-login."""
-        return (len(self.session.cookie_jar.filter_cookies('https://video.logi.com')) == 0 or
-                self._last_status == 401)
+        return not self._authed
+
+    async def _ensure_logged_in(self):
+        """Login once if needed, concurrent callers wait for the same login."""
+        if not self.needs_login:
+            return
+        async with self._login_lock:
+            if self.needs_login:
+                await self.async_login()
 
     async def async_fetch_cameras(self):
         """Fetch camera snapshort image (jpeg encoded) in async fashion."""
-        if self.needs_login:
-            await self.async_login()
-
         accessories_json = await self._fetch_json('https://video.logi.com/api/accessories')
         cameras = []
         if accessories_json:
@@ -67,97 +258,135 @@ class LogiPlatform:
                 cameras.append(cam)
         return cameras
 
+    async def async_fetch_activities_all(self, cams):
+        """Fetch activities for several cameras concurrently.
+
+        Returns a dictionary of activities keyed by accessory id, cameras
+        which failed to fetch are logged and left out.
+        """
+        tasks = [cam.async_fetch_activities() for cam in cams]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        activities = {}
+        for cam, result in zip(cams, results):
+            if isinstance(result, Exception):
+                _LOGGER.error("Error fetching activities for %s: %s", cam.name, result)
+                continue
+            activities[cam.accessory_id] = result
+        return activities
+
+    def _request(self, method, url, session=None, **kwargs):
+        """Return context manager performing a platform request.
+
+        Uses the platform session unless another session is given. The
+        concurrency slot is held until the response is released, including
+        reading the body.
+        """
+        return _PlatformRequest(self, method, url, session or self.session, kwargs)
+
     async def _fetch_json(self, url):
         """Fetch json from platform by specified url."""
-        async with self.session.get(url, headers={'content-type': 'application/json'}) as response:
-            self._last_status = response.status
-            return await response.json()
+        async with self._request('GET', url) as response:
+            return _json_loads(await response.read())
+
+class CamSpec:
+    """Camera attributes parsed from accessory json."""
+
+    __slots__ = ('name', 'accessory_id', 'node_id')
+
+    def __init__(self, name, accessory_id, node_id):
+        """Init with camera attributes."""
+        self.name = name
+        self.accessory_id = accessory_id
+        self.node_id = node_id
+
+    @classmethod
+    def from_json(cls, spec):
+        """Build from accessory json dictionary."""
+        return cls(name=spec['name'], accessory_id=spec['accessoryId'],
+                   node_id=spec['nodeId'])
+
 
 class LogiCam:
     """Naive implementation using still image url from Logi Cirle 2 camera."""
+
+    # Seconds between accessory info refreshes on the image path.
+    INFO_TTL = 300
+    # Seconds before retrying a failed accessory info refresh.
+    INFO_RETRY = 60
+
+    # Unique token appended to still image urls to defeat proxy caching.
+    _anticache = itertools.count(int(time.time() * 1000))
+
     def __init__(self, platform, spec):
         """Init with platform and camera json dictionary."""
-        self._platform = weakref.ref(platform)
-        self._spec = spec
+        self._platform = platform
+        self._info_due_ts = 0
+        self._set_spec(spec)
+
+    def _set_spec(self, spec):
+        """Update camera attributes and urls from accessory json."""
+        self.spec = CamSpec.from_json(spec)
+        self._image_url_prefix = 'https://{}/api/accessories/{}/image?anticache='.format(
+            self.node_id, self.accessory_id)
+        self.activities_url = 'https://video.logi.com/api/accessories/{}/activities'.format(
+            self.accessory_id)
+        self.accessory_info_url = 'https://video.logi.com/api/accessories/{}'.format(
+            self.accessory_id)
 
     @property
     def name(self):
         """Name of camera."""
-        return self._spec['name']
+        return self.spec.name
 
     @property
     def accessory_id(self):
         """Identifer of receiver."""
-        return self._spec['accessoryId']
+        return self.spec.accessory_id
 
     @property
     def node_id(self):
         """Node id."""
-        return self._spec['nodeId']
+        return self.spec.node_id
 
     @property
     def still_image_url(self):
         """Url to get still image from camera."""
-        js_timestamp = int(time.time() * 1000)
-        return 'https://{}/api/accessories/{}/image?anticache={}'.format(self.node_id,
-                                                                         self.accessory_id,
-                                                                         js_timestamp)
-
-    @property
-    def activities_url(self):
-        """Url to get a list of activities videos."""
-        return 'https://video.logi.com/api/accessories/{}/activities'.format(self.accessory_id)
-
-    @property
-    def accessory_info_url(self):
-        """Url to get info for accessory."""
-        return 'https://video.logi.com/api/accessories/{}'.format(self.accessory_id)
+        return self._image_url_prefix + str(next(LogiCam._anticache))
 
     async def async_fetch_accessory_info(self):
         """Fetch accessory info."""
-        if self._platform().needs_login:
-            await self._platform().async_login()
-
-        headers = {'content-type': 'application/json'}
-        async with self._platform().session.get(self.accessory_info_url,
-                                                headers=headers) as response:
-            self._last_status = response.status
+        # Failed or raising fetches are retried after INFO_RETRY seconds.
+        self._info_due_ts = time.monotonic() + self.INFO_RETRY
+        async with self._platform._request('GET', self.accessory_info_url) as response:
             if response.status < 400:
-                self._spec = await response.json()                
+                self._set_spec(_json_loads(await response.read()))
+                self._info_due_ts = time.monotonic() + self.INFO_TTL
 
     async def async_fetch_image(self):
         """Fetch snapshort image in async fashion."""
-        if self._platform().needs_login:
-            await self._platform().async_login()
+        if time.monotonic() > self._info_due_ts:
+            await self.async_fetch_accessory_info()
 
-        await self.async_fetch_accessory_info()
-
-        if self._platform().needs_login:
-            await self._platform().async_login()
         headers = {'content-type': 'image/jpeg',
                    'Cache-Control': 'no-cache'}
-        _LOGGER.info('LOGICIRCLE: websession: {}'.format(self._platform().session))
-        async with self._platform().session.get(self.still_image_url,
-                                                headers=headers) as response:
-            self._last_status = response.status
-            image_data = await response.read()
-            _LOGGER.info("LOGICIRCLE: status: {}".format(response.status))
+        session = self._platform.session_for(self.node_id)
+        async with self._platform._request('GET', self.still_image_url,
+                                           session=session,
+                                           headers=headers) as response:
+            image_data = await _async_read_body(response)
+            _LOGGER.debug("LOGICIRCLE: status: %s", response.status)
             return image_data
 
     async def async_fetch_activities(self):
         """Fetc a list of detected activities videos in async fashion."""
-        if self._platform().needs_login:
-            await self._platform().async_login()
-
         payload = {'extraFields': ['activitySet'], 'operator': '<=',
                    'limit': 80, 'scanDirectionNewer': True,
                    'filter': 'relevanceLevel = 0 OR relevanceLevel >= 1'}
-        headers = {'Content-type': 'application/json',
-                   'Accept': 'application/json, text/plain, */*'}
-        async with self._platform().session.post(self.activities_url,
-                                                 headers=headers, json=payload) as response:
-            activities_response = await response.json()
-            self._last_status = response.status
+        headers = {'Accept': 'application/json, text/plain, */*'}
+        async with self._platform._request('POST', self.activities_url,
+                                           headers=headers,
+                                           data=_json_dumps(payload)) as response:
+            activities_response = _json_loads(await response.read())
             return activities_response['activities']
 
 
@@ -167,15 +396,23 @@ async def async_setup_platform(hass, config, async_add_devices, discovery_info=N
     username = config.get(CONF_USERNAME)
     password = config.get(CONF_PASSWORD)
 
+    logi_platform = LogiPlatform(username, password)
     try:
-        websession = async_get_clientsession(hass)
-        logi_platform = LogiPlatform(username, password, websession)
         cameras = await logi_platform.async_fetch_cameras()
         devices = []
         for camera in cameras:
             devices.append(LogiCircleCamera(hass, camera))
+
+        async def _async_close_platform(event):
+            """Stop camera refresh and close platform session on shutdown."""
+            for device in devices:
+                device.stop_refresh()
+            await logi_platform.async_close()
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_CLOSE, _async_close_platform)
         hass.data[PLATFORM] = logi_platform
     except Exception as ex:
+        await logi_platform.async_close()
         hass.components.persistent_notification.async_create(
             "Error: {}<br />"
             "Please restart hass after fixing this."
@@ -197,6 +434,64 @@ class LogiCircleCamera(Camera):
         self.logi_cam_device = logi_cam_device
         self._frame_interval = 0.2
         self._last_image = None
+        self._cache_ts = 0
+        self._cache_ttl = 1.0
+        self._inflight = None
+        self._task = None
+        self._failures = 0
+        self._retry_ts = 0
+        self._last_demand = 0
+        self._demand = asyncio.Event()
+
+    async def async_added_to_hass(self):
+        """Start refreshing camera image in background."""
+        self._task = self.hass.loop.create_task(self._async_refresher())
+
+    async def async_will_remove_from_hass(self):
+        """Stop background image refresh."""
+        self.stop_refresh()
+
+    def stop_refresh(self):
+        """Cancel background refresh and any in-flight fetch."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._inflight is not None:
+            self._inflight.cancel()
+
+    async def _async_refresher(self):
+        """Keep the last camera image fresh every frame interval.
+
+        Refresh pauses while no consumer asks for images.
+        """
+        while True:
+            if self._is_idle():
+                self._demand.clear()
+                # Re-check after clear so a consumer arriving meanwhile
+                # is not missed.
+                if self._is_idle():
+                    await self._demand.wait()
+            try:
+                await self._async_refresh_image()
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Unexpected error refreshing camera image")
+            await asyncio.sleep(self._frame_interval)
+
+    def _is_idle(self):
+        """Return True if no consumer asked for images recently."""
+        return time.monotonic() - self._last_demand > IDLE_FRAME_COUNT * self._frame_interval
+
+    def _mark_demand(self):
+        """Record a consumer request, waking a paused refresher."""
+        self._last_demand = time.monotonic()
+        if not self._demand.is_set():
+            self.hass.loop.call_soon_threadsafe(self._demand.set)
+
+    def _is_stale(self):
+        """Return True if the cached image predates a refresh pause."""
+        return time.monotonic() - self._cache_ts > IDLE_FRAME_COUNT * self._frame_interval
 
     @property
     def frame_interval(self):
@@ -205,21 +500,58 @@ class LogiCircleCamera(Camera):
 
     def camera_image(self):
         """Return bytes of camera image."""
+        self._mark_demand()
+        fresh = self._last_image is not None and not self._is_stale()
+        if fresh or _in_event_loop(self.hass.loop):
+            # Cached image needs no loop round trip, and the loop thread
+            # must not block waiting on itself.
+            return self._last_image
         return run_coroutine_threadsafe(
             self.async_camera_image(), self.hass.loop).result()
 
     async def async_camera_image(self):
-        """Return a still image response from the camera."""
+        """Return the last still image fetched from the camera."""
+        self._mark_demand()
+        if self._last_image is None or self._is_stale():
+            # Nothing cached yet or refresh was paused, wait for a fetch.
+            return await self._async_refresh_image()
+        return self._last_image
+
+    async def _async_refresh_image(self):
+        """Fetch a new still image unless the cached one is still fresh."""
+        now = time.monotonic()
+        if now - self._cache_ts < self._cache_ttl or now < self._retry_ts:
+            return self._last_image
+
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._async_fetch_image())
+        # Shield so a cancelled poller leaves the shared fetch running for
+        # the others, the fetch itself is bounded by IMAGE_FETCH_TIMEOUT.
+        return await asyncio.shield(self._inflight)
+
+    async def _async_fetch_image(self):
+        """Fetch still image from device and update the cached one.
+
+        Failed fetches back off exponentially up to MAX_RETRY_INTERVAL.
+        """
+        fetched = False
         try:
-            with async_timeout.timeout(10, loop=self.hass.loop):
-                self._last_image = await self.logi_cam_device.async_fetch_image()
+            self._last_image = await asyncio.wait_for(
+                self.logi_cam_device.async_fetch_image(), timeout=IMAGE_FETCH_TIMEOUT)
+            self._cache_ts = time.monotonic()
+            fetched = True
         except asyncio.TimeoutError:
             _LOGGER.error("Timeout getting camera image")
-            return self._last_image
-        except aiohttp.ClientError as err:
+        except (aiohttp.ClientError, ValueError) as err:
             _LOGGER.error("Error getting new camera image: %s", err)
-            return self._last_image
-
+        finally:
+            self._inflight = None
+            if fetched:
+                self._failures = 0
+            else:
+                self._failures += 1
+                self._retry_ts = time.monotonic() + min(
+                    self._frame_interval * 2 ** min(self._failures, 16), MAX_RETRY_INTERVAL)
         return self._last_image
 
     def should_poll(self):